@@ -0,0 +1,35 @@
+import re
+
+# --- Input preflight ---
+# Inputs too short or vague for the AI to work with get a canned reply instead of an API call.
+MIN_INPUT_CHARS = 20
+MIN_INPUT_WORDS = 4
+STOPWORDS = frozenset({
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "do", "for", "from", "have", "help",
+    "i", "in", "is", "it", "me", "my", "no", "not", "of", "on", "or", "so", "that", "the", "this",
+    "to", "was", "what", "when", "why", "with", "yes",
+})
+# Chinese and Japanese are written without spaces and pack a word into one or two characters,
+# so text in those scripts is measured in characters against its own, lower minimum
+UNSPACED_SCRIPT_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+MIN_UNSPACED_CHARS = 8
+PREFLIGHT_MESSAGE = "Please provide more detail (at least 20 characters and a few words), including what happens, when it happens, and why it's a problem for you."
+
+def preflight_input(text):
+    """
+    Returns a message asking for more detail if the text is too short or vague to send to the AI,
+    otherwise None.
+    """
+    stripped = text.strip()
+    unspaced_chars = len(UNSPACED_SCRIPT_RE.findall(stripped))
+    if unspaced_chars:
+        too_short = unspaced_chars < MIN_UNSPACED_CHARS
+    else:
+        too_short = len(stripped) < MIN_INPUT_CHARS or len(stripped.split()) < MIN_INPUT_WORDS
+    if too_short:
+        return PREFLIGHT_MESSAGE
+    # \w is Unicode-aware, so text in any script yields words; only English stopwords are listed
+    words = re.findall(r"\w+", stripped.lower())
+    if words and all(word in STOPWORDS for word in words):
+        return PREFLIGHT_MESSAGE
+    return None
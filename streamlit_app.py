@@ -1,77 +1,411 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import diskcache
+import orjson
 import os
+import re
+import hashlib
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from preflight import preflight_input
+
+# Must be the first Streamlit command, so the page is configured even if the API key check below stops the script
+st.set_page_config(layout="centered", page_title="Structured AI Problem-Solver")
 
 # --- Configuration ---
 # Access the Gemini API Key securely from Streamlit secrets
 # In Streamlit Cloud, you'll set this under 'Secrets' (e.g., API_KEY="YOUR_GEMINI_API_KEY")
 # For local testing, you can create a .streamlit/secrets.toml file:
 # API_KEY = "YOUR_GEMINI_API_KEY"
+# The lookup is cached for the life of the server so reruns don't re-read the secrets file.
+@st.cache_resource
+def get_api_key():
+    return st.secrets["API_KEY"]
+
 try:
-    GEMINI_API_KEY = st.secrets["API_KEY"]
-except FileNotFoundError:
-    st.error("API Key not found. Please set 'API_KEY' in your Streamlit secrets or in .streamlit/secrets.toml for local development.")
-    st.stop()
-except KeyError:
+    GEMINI_API_KEY = get_api_key()
+except (FileNotFoundError, KeyError):
     st.error("API Key not found. Please set 'API_KEY' in your Streamlit secrets or in .streamlit/secrets.toml for local development.")
     st.stop()
 
 
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+GEMINI_MODEL = "gemini-2.0-flash"
+GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent"
+GEMINI_STREAM_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:streamGenerateContent"
+GEMINI_API_PARAMS = {'key': GEMINI_API_KEY}
+GEMINI_STREAM_PARAMS = {**GEMINI_API_PARAMS, 'alt': 'sse'}
+GEMINI_API_HEADERS = {'Content-Type': 'application/json'}
+GEMINI_API_TIMEOUT = (3.05, 30) # (connect, read) in seconds
+# Upper bound on concurrent Gemini calls across all sessions; sizes both the HTTP pool and the background executor
+MAX_CONCURRENT_API_CALLS = 16
+# Shown in place of an AI response when the call fails; never cached
+AI_FAILURE_MESSAGE = "Error: Could not get a valid response from AI. Please try again."
+RESPONSE_CACHE_PATH = "/tmp/llm_cache"
+RESPONSE_CACHE_SIZE_LIMIT = 200 * 1024 * 1024 # 200 MB, oldest entries are evicted past this
+RESPONSE_CACHE_TTL = 24 * 60 * 60 # One day, in seconds
+
+# Step-3 prompts are also cached on disk by template and slot values, with an
+# embedding-similarity fallback for near-identical submissions.
+SOLUTION_TEMPLATE_ID = "solution_v1"
+FEEDBACK_TEMPLATE_ID = "feedback_v1"
+TEMPLATE_CACHE_PATH = "/tmp/llm_template_cache"
+TEMPLATE_CACHE_SIZE_LIMIT = 100 * 1024 * 1024 # 100 MB, oldest entries are evicted past this
+TEMPLATE_CACHE_TTL = 7 * 24 * 60 * 60 # One week, in seconds
+SEMANTIC_MATCH_THRESHOLD = 0.92
+TEMPLATE_INDEX_MAX_ROWS = 5000 # Newest entries kept in the in-memory similarity index
+TEMPLATE_INDEX_MAX_CANDIDATES = 5 # Best-scoring index rows checked against the cache per lookup
+EMBEDDING_MODEL = "text-embedding-004"
+EMBEDDING_CACHE_PATH = "/tmp/llm_embedding_cache"
+EMBEDDING_CACHE_SIZE_LIMIT = 100 * 1024 * 1024 # 100 MB, oldest entries are evicted past this
+EMBEDDING_CACHE_TTL = TEMPLATE_CACHE_TTL
+EMBEDDING_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{EMBEDDING_MODEL}:batchEmbedContents"
+
+# --- Prompt templates ---
+# Built once at import; each step fills in the user's input with format_map.
+QUESTIONS_PROMPT_TEMPLATE = """As a student, I have the following problem: "{problem}". To help me understand this problem better and find a solution, please ask me 3-5 concise, insightful follow-up questions. Format them as a numbered list."""
+
+STEP3_CONTEXT_TEMPLATE = """As a student, I need help solving a problem. Here's a structured overview of my situation:
+
+Problem: "{problem}"
+
+My answers to follow-up questions that clarify the problem:
+"{answers}"
+
+Relevant events or specific details that happened:
+"{events}"
+"""
+
+SOLUTION_PROMPT_TEMPLATE = STEP3_CONTEXT_TEMPLATE + """
+Based on ALL this information, provide a clear, actionable solution or a set of steps to address my problem."""
+
+FEEDBACK_PROMPT_TEMPLATE = STEP3_CONTEXT_TEMPLATE + """
+Based on ALL this information, provide constructive feedback on my overall understanding of the problem and the clarity of the information I provided, suggesting how I could further refine my problem-solving approach in the future."""
+
+# Matches a leading "Solution:"/"Feedback:" heading, including markdown variants like
+# "**Solution:**" or "### Feedback", which the model sometimes adds despite the page's own headings.
+SECTION_HEADING_RE = re.compile(r'\A\s*(?:#+\s*|\*\*)?(?:solution|feedback)\s*:?\s*(?:\*\*)?\s*:?[ \t]*\n', re.IGNORECASE)
+
+# --- Retry policy ---
+MAX_RETRY_WAIT = 10 # Seconds; caps both backoff and server-sent Retry-After waits
+
+class CappedRetry(Retry):
+    """
+    Retry policy that honors Retry-After but never waits longer than MAX_RETRY_WAIT,
+    so a large value from a rate-limited API can't stall a script thread or pool worker.
+    """
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, MAX_RETRY_WAIT)
+
+# --- Shared HTTP session ---
+# Reusing one session keeps the TLS connection to the Gemini API alive between calls.
+# Cached as a resource so Streamlit reruns don't rebuild it.
+@st.cache_resource
+def get_http_session():
+    session = requests.Session()
+    session.headers.update(GEMINI_API_HEADERS)
+    # Transient failures are retried with exponential backoff instead of surfacing to the user.
+    # POST isn't retried by default, but a repeated generate/embed request has no side effects.
+    # Read timeouts are not retried: generateContent sends nothing until generation finishes,
+    # so retrying one would just rerun a long generation from scratch.
+    retries = CappedRetry(
+        total=3,
+        read=False,
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+        backoff_max=MAX_RETRY_WAIT,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["POST"],
+        respect_retry_after_header=True,
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONCURRENT_API_CALLS, max_retries=retries))
+    return session
+
+SESSION = get_http_session()
+
+# --- Response cache ---
+# Exact-match cache of AI responses, keyed by a hash of the model and prompt.
+# Kept on disk so hits carry over across sessions, users, and server restarts.
+@st.cache_resource
+def get_response_cache():
+    return diskcache.Cache(RESPONSE_CACHE_PATH, size_limit=RESPONSE_CACHE_SIZE_LIMIT)
+
+def make_cache_key(prompt):
+    return hashlib.blake2b((GEMINI_MODEL + prompt).encode(), digest_size=16).hexdigest()
+
+def remember_response(cache_key, text):
+    get_response_cache().set(cache_key, text, expire=RESPONSE_CACHE_TTL)
+
+# --- Background API calls ---
+# Lets a Gemini call run while the next step's layout renders.
+# The pool is shared by every session, so it is sized for concurrent users rather than one user's calls.
+@st.cache_resource
+def get_executor():
+    return ThreadPoolExecutor(max_workers=MAX_CONCURRENT_API_CALLS)
 
 # --- Function to call the Gemini API ---
-def call_gemini_api(prompt):
+def post_to_gemini(prompt):
+    """
+    Posts a prompt to the Gemini API and returns the decoded JSON result.
+    Makes no Streamlit calls, so it is safe to run on a worker thread.
     """
-    Sends a prompt to the Gemini API and returns the text response.
+    payload = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+    response = SESSION.post(GEMINI_API_URL, params=GEMINI_API_PARAMS, data=orjson.dumps(payload), timeout=GEMINI_API_TIMEOUT)
+    response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
+    return orjson.loads(response.content)
+
+def submit_gemini_call(prompt):
+    """
+    Starts a Gemini call in the background and returns its future.
+    Returns None when the response is already cached.
     """
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    params = {
-        'key': GEMINI_API_KEY
-    }
-    payload = {
-        "contents": [
-            {
-                "role": "user",
-                "parts": [{"text": prompt}]
-            }
-        ]
-    }
+    if make_cache_key(prompt) in get_response_cache():
+        return None
+    return get_executor().submit(post_to_gemini, prompt)
+
+def report_api_error(error):
+    """
+    Shows an error from a failed Gemini call on the page.
+    """
+    if isinstance(error, json.JSONDecodeError): # Also raised by orjson, whose error subclasses it
+        st.error(f"Error decoding JSON response: {error}. Invalid JSON response from AI.")
+    else:
+        st.error(f"Error calling Gemini API: {error}. Please check your API key and network connection.")
+
+def call_gemini_api(prompt, future=None):
+    """
+    Sends a prompt to the Gemini API and returns the text response, or None if the call failed.
+    If a future from submit_gemini_call is given, waits on it instead of posting again.
+    Successful responses are cached so repeated prompts skip the network round-trip.
+    """
+    cache_key = make_cache_key(prompt)
+    cached_text = get_response_cache().get(cache_key)
+    if cached_text is not None:
+        return cached_text
 
     try:
         with st.spinner("AI is thinking..."):
-            response = requests.post(GEMINI_API_URL, headers=headers, params=params, data=json.dumps(payload))
-            response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
-            result = response.json()
-
-            if result.get('candidates') and len(result['candidates']) > 0 and \
-               result['candidates'][0].get('content') and \
-               result['candidates'][0]['content'].get('parts') and \
-               len(result['candidates'][0]['content']['parts']) > 0:
-                return result['candidates'][0]['content']['parts'][0]['text']
-            else:
-                st.error(f"Unexpected API response structure: {result}")
-                return "Error: Could not get a valid response from AI. Please try again."
-    except requests.exceptions.RequestException as e:
-        st.error(f"Error calling Gemini API: {e}. Please check your API key and network connection.")
-        return "Error: Failed to connect to AI. Please check your network or API key."
-    except json.JSONDecodeError as e:
-        st.error(f"Error decoding JSON response: {e}. Invalid JSON response from AI.")
-        return "Error: Invalid JSON response from AI."
+            result = future.result() if future is not None else post_to_gemini(prompt)
+    except (requests.exceptions.RequestException, json.JSONDecodeError) as e:
+        report_api_error(e)
+        return None
+
+    try:
+        text = result['candidates'][0]['content']['parts'][0]['text']
+    except (KeyError, IndexError, TypeError):
+        st.error(f"Unexpected API response structure: {result}")
+        return None
+    remember_response(cache_key, text)
+    return text
+
+def stream_gemini_api(prompt):
+    """
+    Streams the Gemini API response for a prompt, yielding text chunks as they arrive.
+    Meant to be passed to st.write_stream; the full text is cached once the stream ends.
+    Request and decoding errors are raised to the caller, which should pass them to report_api_error.
+    """
+    cache_key = make_cache_key(prompt)
+    cached_text = get_response_cache().get(cache_key)
+    if cached_text is not None:
+        yield cached_text
+        return
+
+    payload = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+    chunks = []
+    with SESSION.post(GEMINI_STREAM_URL, params=GEMINI_STREAM_PARAMS, data=orjson.dumps(payload), stream=True, timeout=GEMINI_API_TIMEOUT) as response:
+        response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
+        for line in response.iter_lines():
+            # Server-sent events: each frame is a "data: {...}" line holding one partial response
+            if not line.startswith(b"data:"):
+                continue
+            result = orjson.loads(line[len(b"data:"):])
+            try:
+                text = result['candidates'][0]['content']['parts'][0]['text']
+            except (KeyError, IndexError, TypeError):
+                continue # e.g. the final frame, which only carries the finish reason
+            chunks.append(text)
+            yield text
+
+    if chunks:
+        remember_response(cache_key, "".join(chunks))
+
+def strip_section_heading(text):
+    return SECTION_HEADING_RE.sub("", text, count=1)
+
+# --- Template-aware cache for the Step-3 prompts ---
+# Each entry holds the responses generated for a set of slot values, by template id. The slot
+# embeddings are stored separately under ("vectors", key), so the similarity index can be
+# rebuilt without reading any response text.
+@st.cache_resource
+def get_template_cache():
+    return diskcache.Cache(TEMPLATE_CACHE_PATH, size_limit=TEMPLATE_CACHE_SIZE_LIMIT)
+
+def slot_matrix(embeddings):
+    """
+    Stacks slot embeddings (in slot-name order) into a float32 matrix of unit-length rows.
+    """
+    matrix = np.array([embeddings[name] for name in sorted(embeddings)], dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+@st.cache_resource
+def get_template_index():
+    """
+    In-memory index of the newest cached entries' slot embeddings, loaded once per server process.
+    """
+    cache = get_template_cache()
+    vector_keys = [key for key in cache.iterkeys() if isinstance(key, tuple)][-TEMPLATE_INDEX_MAX_ROWS:]
+    index = {'lock': threading.Lock(), 'keys': [], 'vectors': None}
+    for vector_key in vector_keys:
+        vectors = cache.get(vector_key) # None if the entry expired since iteration started
+        if vectors is not None:
+            add_to_template_index(index, vector_key[1], vectors)
+    return index
+
+def add_to_template_index(index, key, vectors):
+    # Arrays are replaced rather than resized in place, so lookups can score a snapshot outside the lock
+    with index['lock']:
+        if key in index['keys']:
+            return
+        if index['vectors'] is None:
+            index['vectors'] = vectors[np.newaxis]
+        elif index['vectors'].shape[1:] == vectors.shape:
+            index['vectors'] = np.concatenate([index['vectors'], vectors[np.newaxis]])[-TEMPLATE_INDEX_MAX_ROWS:]
+        else:
+            return # Embedding size changed (e.g. a new embedding model); skip stale rows
+        index['keys'] = (index['keys'] + [key])[-TEMPLATE_INDEX_MAX_ROWS:]
+
+def normalize_slots(slots):
+    return {name: " ".join(value.split()).lower() for name, value in slots.items()}
+
+def make_template_key(slots):
+    # Parts are fed in one at a time behind NUL separators so adjacent slots can't run together
+    digest = hashlib.blake2b(digest_size=16)
+    for name in sorted(slots):
+        digest.update(name.encode() + b"\x00" + slots[name].encode() + b"\x00")
+    return digest.hexdigest()
+
+# Slot embedding vectors, keyed by slot text, so unchanged slots are never re-embedded.
+@st.cache_resource
+def get_embedding_cache():
+    return diskcache.Cache(EMBEDDING_CACHE_PATH, size_limit=EMBEDDING_CACHE_SIZE_LIMIT)
+
+def make_embedding_key(text):
+    return hashlib.blake2b((EMBEDDING_MODEL + "\x00" + text).encode(), digest_size=16).hexdigest()
+
+def embed_slots(slots):
+    """
+    Embeds every slot value, or returns None if the embeddings API is unavailable.
+    Vectors already in the cache are reused; the rest are fetched together in one batch call.
+    """
+    cache = get_embedding_cache()
+    embeddings = {}
+    missing = []
+    for name, value in slots.items():
+        values = cache.get(make_embedding_key(value))
+        if values is not None:
+            embeddings[name] = values
+        else:
+            missing.append(name)
+    if not missing:
+        return embeddings
+
+    payload = {"requests": [
+        {"model": f"models/{EMBEDDING_MODEL}", "content": {"parts": [{"text": slots[name]}]}}
+        for name in missing
+    ]}
+    try:
+        response = SESSION.post(EMBEDDING_API_URL, params=GEMINI_API_PARAMS, data=orjson.dumps(payload), timeout=GEMINI_API_TIMEOUT)
+        response.raise_for_status()
+        vectors = [result['values'] for result in orjson.loads(response.content)['embeddings']]
+    except (requests.exceptions.RequestException, KeyError, TypeError, ValueError):
+        return None
+    if len(vectors) != len(missing):
+        return None
+
+    for name, values in zip(missing, vectors):
+        cache.set(make_embedding_key(slots[name]), values, expire=EMBEDDING_CACHE_TTL)
+        embeddings[name] = values
+    return embeddings
+
+def lookup_template_cache(template_ids, slots):
+    """
+    Returns a dict of cached responses for the given templates and slot values; missing templates are left out.
+    Tries an exact match first, then the closest indexed entries whose every slot is semantically similar.
+    """
+    slots = normalize_slots(slots)
+    cache = get_template_cache()
+    entry = cache.get(make_template_key(slots))
+    responses = {template_id: entry['responses'][template_id] for template_id in template_ids if entry and template_id in entry['responses']}
+    remaining = [template_id for template_id in template_ids if template_id not in responses]
+    if not remaining:
+        return responses
+
+    embeddings = embed_slots(slots)
+    if embeddings is None:
+        return responses
+
+    index = get_template_index()
+    with index['lock']:
+        keys, vectors = index['keys'], index['vectors']
+    query = slot_matrix(embeddings)
+    if not keys or vectors.shape[1:] != query.shape:
+        return responses
+
+    # Cosine similarity of every slot against every row in one pass; a row's score is its weakest slot
+    scores = np.einsum("nsd,sd->ns", vectors, query).min(axis=1)
+    for row in np.argsort(scores)[::-1][:TEMPLATE_INDEX_MAX_CANDIDATES]:
+        if scores[row] <= SEMANTIC_MATCH_THRESHOLD:
+            break
+        entry = cache.get(keys[row]) # None if the entry expired or was evicted
+        if entry is None:
+            continue
+        for template_id in remaining:
+            if template_id not in responses and template_id in entry['responses']:
+                responses[template_id] = entry['responses'][template_id]
+        if len(responses) == len(template_ids):
+            break
+    return responses
+
+def store_template_cache(template_id, slots, response):
+    slots = normalize_slots(slots)
+    cache = get_template_cache()
+    embeddings = embed_slots(slots) # Outside the transaction, since it may call the API
+    key = make_template_key(slots)
+    with cache.transact():
+        entry = cache.get(key) or {'responses': {}}
+        entry['responses'][template_id] = response
+        cache.set(key, entry, expire=TEMPLATE_CACHE_TTL)
+    if embeddings is not None:
+        vectors = slot_matrix(embeddings)
+        cache.set(("vectors", key), vectors, expire=TEMPLATE_CACHE_TTL)
+        add_to_template_index(get_template_index(), key, vectors)
 
 # --- Initialize Streamlit Session State ---
 # This ensures variables persist across reruns
+SESSION_DEFAULTS = {
+    "current_step": 1,
+    "problem_statement": "",
+    "ai_generated_questions": "",
+    "questions_prompt": "",
+    "questions_future": None,
+    "user_answers_to_questions": "",
+    "supporting_events": "",
+    "final_solution": "",
+    "final_feedback": "",
+    "template_slots": None, # Set to a fresh dict by the Step-3 handler; a shared {} default would leak between sessions
+    "solution_prompt": "",
+    "feedback_prompt": "",
+    "feedback_future": None,
+    "error_message": "",
+}
+
 if 'current_step' not in st.session_state:
-    st.session_state.current_step = 1
-    st.session_state.problem_statement = ""
-    st.session_state.ai_generated_questions = ""
-    st.session_state.user_answers_to_questions = ""
-    st.session_state.supporting_events = ""
-    st.session_state.final_solution = ""
-    st.session_state.final_feedback = ""
-    st.session_state.error_message = ""
+    st.session_state.update(SESSION_DEFAULTS)
 
 # --- Callbacks for Navigation ---
 def next_step():
@@ -82,18 +416,9 @@ def set_error_message(message):
     st.session_state.error_message = message
 
 def restart_app():
-    st.session_state.current_step = 1
-    st.session_state.problem_statement = ""
-    st.session_state.ai_generated_questions = ""
-    st.session_state.user_answers_to_questions = ""
-    st.session_state.supporting_events = ""
-    st.session_state.final_solution = ""
-    st.session_state.final_feedback = ""
-    st.session_state.error_message = ""
+    st.session_state.update(SESSION_DEFAULTS)
 
 # --- Application Layout ---
-st.set_page_config(layout="centered", page_title="Structured AI Problem-Solver")
-
 st.title("🧠 Structured AI Problem-Solver")
 st.markdown("A step-by-step assistant to help students **define, understand, and solve problems** with AI guidance.")
 st.markdown("---")
@@ -119,12 +444,17 @@ if st.session_state.current_step == 1:
         if st.button("Submit Problem & Get Questions", key="submit_problem_btn"):
             if not st.session_state.problem_statement.strip():
                 set_error_message("Please describe your problem to proceed.")
+            elif preflight_message := preflight_input(st.session_state.problem_statement):
+                set_error_message(preflight_message)
+                st.rerun() # The error banner has already rendered this run
             else:
-                prompt_questions = f"""As a student, I have the following problem: "{st.session_state.problem_statement}". To help me understand this problem better and find a solution, please ask me 3-5 concise, insightful follow-up questions. Format them as a numbered list."""
-                ai_response = call_gemini_api(prompt_questions)
-                if "Error" not in ai_response:
-                    st.session_state.ai_generated_questions = ai_response
-                    next_step()
+                prompt_questions = QUESTIONS_PROMPT_TEMPLATE.format_map({"problem": st.session_state.problem_statement})
+                # Fetch the questions in the background and move on so Step 2 renders right away
+                st.session_state.questions_prompt = prompt_questions
+                st.session_state.questions_future = submit_gemini_call(prompt_questions)
+                st.session_state.ai_generated_questions = ""
+                next_step()
+                st.rerun()
     with col2:
         st.markdown(
             """
@@ -141,7 +471,9 @@ elif st.session_state.current_step == 2:
     st.write("The AI has generated some questions to help you think more deeply about your problem. Please answer them to provide more context.")
 
     st.subheader("AI's Clarifying Questions:")
-    st.info(st.session_state.ai_generated_questions)
+    questions_placeholder = st.empty()
+    if st.session_state.ai_generated_questions:
+        questions_placeholder.info(st.session_state.ai_generated_questions)
 
     st.session_state.user_answers_to_questions = st.text_area(
         "Your Answers:",
@@ -167,6 +499,20 @@ elif st.session_state.current_step == 2:
             """, unsafe_allow_html=True
         )
 
+    # Resolve the questions requested in Step 1 once the rest of the step is on screen
+    if st.session_state.questions_prompt:
+        with questions_placeholder.container():
+            ai_response = call_gemini_api(st.session_state.questions_prompt, st.session_state.questions_future)
+        st.session_state.questions_prompt = ""
+        st.session_state.questions_future = None
+        if ai_response is not None:
+            st.session_state.ai_generated_questions = ai_response
+            questions_placeholder.info(ai_response)
+        else:
+            st.session_state.current_step = 1
+            set_error_message(AI_FAILURE_MESSAGE)
+            st.rerun()
+
 
 # --- Step 3: Provide Supporting Events ---
 elif st.session_state.current_step == 3:
@@ -186,45 +532,34 @@ elif st.session_state.current_step == 3:
         if st.button("Get Solution & Feedback", key="get_solution_btn"):
             if not st.session_state.supporting_events.strip():
                 set_error_message("Please provide some relevant events or details to proceed.")
+            elif preflight_message := preflight_input(st.session_state.supporting_events):
+                set_error_message(preflight_message)
+                st.rerun() # The error banner has already rendered this run
             else:
-                # Consolidate all information for the final AI call
-                full_context_prompt = f"""As a student, I need help solving a problem. Here's a structured overview of my situation:
-
-Problem: "{st.session_state.problem_statement}"
-
-My answers to follow-up questions that clarify the problem:
-"{st.session_state.user_answers_to_questions}"
-
-Relevant events or specific details that happened:
-"{st.session_state.supporting_events}"
-
-Based on ALL this information, please do two things:
-1. Provide a clear, actionable solution or a set of steps to address my problem.
-2. Provide constructive feedback on my overall understanding of the problem and the clarity of the information I provided, suggesting how I could further refine my problem-solving approach in the future.
-Format your response clearly with 'Solution:' and 'Feedback:' headings."""
-
-                ai_response_full = call_gemini_api(full_context_prompt)
-
-                # Attempt to parse solution and feedback
-                if "Solution:" in ai_response_full and "Feedback:" in ai_response_full:
-                    parts = ai_response_full.split("Solution:", 1)
-                    solution_part = parts[1] if len(parts) > 1 else ""
-
-                    if "Feedback:" in solution_part:
-                        solution_text = solution_part.split("Feedback:", 1)[0].strip()
-                        feedback_text = solution_part.split("Feedback:", 1)[1].strip()
-                    else: # Fallback if Feedback is not after Solution
-                        solution_text = solution_part.strip()
-                        feedback_text = "No explicit 'Feedback:' section found after solution."
-
-                    st.session_state.final_solution = solution_text
-                    st.session_state.final_feedback = feedback_text
-                else:
-                    # Fallback if AI doesn't use the exact headings
-                    st.session_state.final_solution = "Could not parse specific solution/feedback sections. Full AI response:\n" + ai_response_full
-                    st.session_state.final_feedback = ""
+                # Consolidate all information for the final AI calls
+                slots = {
+                    "problem": st.session_state.problem_statement,
+                    "answers": st.session_state.user_answers_to_questions,
+                    "events": st.session_state.supporting_events,
+                }
+                solution_prompt = SOLUTION_PROMPT_TEMPLATE.format_map(slots)
+                feedback_prompt = FEEDBACK_PROMPT_TEMPLATE.format_map(slots)
+                with st.spinner("Checking for similar problems..."):
+                    cached = lookup_template_cache([SOLUTION_TEMPLATE_ID, FEEDBACK_TEMPLATE_ID], slots)
+                solution = cached.get(SOLUTION_TEMPLATE_ID)
+                feedback = cached.get(FEEDBACK_TEMPLATE_ID)
+
+                # Whatever wasn't cached is generated in Step 4: the feedback starts in the
+                # background now, and the solution is streamed onto the page there.
+                st.session_state.template_slots = slots
+                st.session_state.final_solution = solution or ""
+                st.session_state.final_feedback = feedback or ""
+                st.session_state.solution_prompt = solution_prompt if solution is None else ""
+                st.session_state.feedback_prompt = feedback_prompt if feedback is None else ""
+                st.session_state.feedback_future = submit_gemini_call(feedback_prompt) if feedback is None else None
 
                 next_step()
+                st.rerun()
     with col2:
         st.markdown(
             """
@@ -239,9 +574,27 @@ elif st.session_state.current_step == 4:
     st.header("Step 4: AI's Solution & Feedback")
     st.write("Based on all the information you provided, here is the AI's suggested solution and feedback on your problem-solving process.")
 
-    if st.session_state.final_solution:
+    if st.session_state.final_solution or st.session_state.solution_prompt:
         st.subheader("Suggested Solution:")
-        st.markdown(st.session_state.final_solution)
+        if st.session_state.solution_prompt:
+            # Streamed into a placeholder so the text can be swapped for its heading-stripped form afterwards
+            solution_placeholder = st.empty()
+            try:
+                with solution_placeholder:
+                    solution = st.write_stream(stream_gemini_api(st.session_state.solution_prompt))
+            except (requests.exceptions.RequestException, json.JSONDecodeError) as e:
+                report_api_error(e)
+                solution = None
+            if solution:
+                solution = strip_section_heading(solution)
+                solution_placeholder.markdown(solution)
+                store_template_cache(SOLUTION_TEMPLATE_ID, st.session_state.template_slots, solution)
+                st.session_state.final_solution = solution
+            else:
+                st.session_state.final_solution = AI_FAILURE_MESSAGE
+            st.session_state.solution_prompt = ""
+        else:
+            st.markdown(st.session_state.final_solution)
         st.markdown(
             """
             <div style="padding: 10px; background-color: #e6ffe6; border-radius: 8px; border: 1px solid #c6ffc6;">
@@ -250,6 +603,17 @@ elif st.session_state.current_step == 4:
             """, unsafe_allow_html=True
         )
 
+    if st.session_state.feedback_prompt:
+        feedback = call_gemini_api(st.session_state.feedback_prompt, st.session_state.feedback_future)
+        if feedback is not None:
+            feedback = strip_section_heading(feedback)
+            store_template_cache(FEEDBACK_TEMPLATE_ID, st.session_state.template_slots, feedback)
+            st.session_state.final_feedback = feedback
+        else:
+            st.session_state.final_feedback = AI_FAILURE_MESSAGE
+        st.session_state.feedback_prompt = ""
+        st.session_state.feedback_future = None
+
     if st.session_state.final_feedback:
         st.subheader("Feedback on Your Process:")
         st.markdown(st.session_state.final_feedback)
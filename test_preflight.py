@@ -0,0 +1,28 @@
+from preflight import PREFLIGHT_MESSAGE, preflight_input
+
+
+def test_rejects_short_input():
+    assert preflight_input("   too short   ") == PREFLIGHT_MESSAGE
+
+
+def test_rejects_too_few_words():
+    assert preflight_input("Procrastination everywhere!!!") == PREFLIGHT_MESSAGE
+
+
+def test_rejects_short_unspaced_script_input():
+    assert preflight_input("作业迟交") == PREFLIGHT_MESSAGE
+
+
+def test_rejects_stopword_only_input():
+    assert preflight_input("what is this and why is it") == PREFLIGHT_MESSAGE
+
+
+def test_accepts_detailed_input():
+    assert preflight_input("I procrastinate on my assignments every week") is None
+
+
+def test_accepts_non_latin_input():
+    assert preflight_input("Я постоянно опаздываю со сдачей домашних заданий") is None
+    assert preflight_input("我总是拖延作业，经常错过截止日期") is None
+    assert preflight_input("宿題をいつも遅れて提出してしまいます") is None
+    assert preflight_input("Αργώ πάντα να παραδώσω τις εργασίες μου στην ώρα τους") is None